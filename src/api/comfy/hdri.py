@@ -1,20 +1,15 @@
 """For hdri generation."""
 
-import asyncio
-import json
 import logging
 
-import requests
-
 from src.api.comfy.shared import (
-    CLIENT_ID,
-    PROMPT_DIR,
-    SERVER_ADDRESS,
     GenerationTask,
-    PromptQueueResponse,
     get_file,
-    get_history,
+    load_workflow,
+    override_inputs,
+    submit_prompt,
     track_progress,
+    wait_for_history,
 )
 
 # NOTE: This is very workflow dependent.
@@ -24,26 +19,28 @@ COMFY_INPUT_TEXT_NODE = "27"
 
 log = logging.getLogger("app.api.comfy.hdri")
 
+# Workflow doesn't change at runtime, so only parse it once.
+PROMPT_TEMPLATE = load_workflow(PROMPT_NAME)
+
 
 # Clip description should be comma-separated, t5 description should be natural prose.
-def queue_prompt(t5_description: str, clip_description: str):
+async def queue_prompt(t5_description: str, clip_description: str):
     """Submit a prompt to ComfyUI's queue."""
-    with open(PROMPT_DIR / PROMPT_NAME, "r") as file:
-        prompt = json.load(file)
-
-    prompt[COMFY_INPUT_TEXT_NODE]["inputs"]["clip_l"] = clip_description
-    prompt[COMFY_INPUT_TEXT_NODE]["inputs"]["t5xxl"] = t5_description
-
-    data = {"prompt": prompt, "client_id": CLIENT_ID}
-    headers = {"Content-Type": "application/json"}
-    resp = requests.post(f"{SERVER_ADDRESS}/prompt", json=data, headers=headers)
-    obj = PromptQueueResponse.model_validate_json(resp.content)
-    return obj
+    prompt = override_inputs(
+        PROMPT_TEMPLATE,
+        {
+            COMFY_INPUT_TEXT_NODE: {
+                "clip_l": clip_description,
+                "t5xxl": t5_description,
+            },
+        },
+    )
+    return await submit_prompt(prompt)
 
 
 async def generate_hdri_prompt(t5_description: str, clip_description: str):
     """Generator that uses ComfyUI to generate HDRI from user's description."""
-    prompt_meta = queue_prompt(t5_description, clip_description)
+    prompt_meta = await queue_prompt(t5_description, clip_description)
 
     async for status in track_progress(prompt_meta.prompt_id):
         if isinstance(status, str):
@@ -55,10 +52,11 @@ async def generate_hdri_prompt(t5_description: str, clip_description: str):
                 yield False, "An error occurred during generation."
                 return
 
-    await asyncio.sleep(1)
-    hist_data = get_history(prompt_meta.prompt_id)
+    hist_data = await wait_for_history(prompt_meta.prompt_id, COMFY_OUTPUT_IMG_NODE)
     imginfo = hist_data.outputs[COMFY_OUTPUT_IMG_NODE]["images"][0]
-    raw_file = get_file(imginfo["filename"], imginfo["subfolder"], imginfo["type"])
+    raw_file = await get_file(
+        imginfo["filename"], imginfo["subfolder"], imginfo["type"]
+    )
     yield True, raw_file
 
 
@@ -1,23 +1,16 @@
 """For object generation."""
 
-import asyncio
-import json
 import logging
 
-import requests
-from PIL import Image
-
 from src.api.comfy.shared import (
-    CLIENT_ID,
-    PROMPT_DIR,
-    SERVER_ADDRESS,
     GenerationTask,
     ImageMetadata,
-    PromptQueueResponse,
     get_file,
-    get_history,
+    load_workflow,
+    override_inputs,
+    submit_prompt,
     track_progress,
-    upload_image,
+    wait_for_history,
 )
 
 # NOTE: This is very workflow dependent.
@@ -28,26 +21,25 @@ COMFY_INPUT_TEXT_NODE = "192"
 
 log = logging.getLogger("app.api.comfy.obj")
 
+# Workflow doesn't change at runtime, so only parse it once.
+PROMPT_TEMPLATE = load_workflow(PROMPT_NAME)
 
-def queue_prompt(image_metadata: ImageMetadata, sketch_description: str):
-    """Submit a prompt to ComfyUI's queue."""
-    with open(PROMPT_DIR / PROMPT_NAME, "r") as file:
-        prompt = json.load(file)
-
-    prompt[COMFY_INPUT_IMG_NODE]["inputs"]["image"] = image_metadata.name
-    prompt[COMFY_INPUT_TEXT_NODE]["inputs"]["text"] = sketch_description
 
-    data = {"prompt": prompt, "client_id": CLIENT_ID}
-    headers = {"Content-Type": "application/json"}
-    resp = requests.post(f"{SERVER_ADDRESS}/prompt", json=data, headers=headers)
-    obj = PromptQueueResponse.model_validate_json(resp.content)
-    return obj
+async def queue_prompt(image_metadata: ImageMetadata, sketch_description: str):
+    """Submit a prompt to ComfyUI's queue."""
+    prompt = override_inputs(
+        PROMPT_TEMPLATE,
+        {
+            COMFY_INPUT_IMG_NODE: {"image": image_metadata.name},
+            COMFY_INPUT_TEXT_NODE: {"text": sketch_description},
+        },
+    )
+    return await submit_prompt(prompt)
 
 
-async def generate_3d_prompt(image: Image.Image, sketch_description: str):
+async def generate_3d_prompt(img_meta: ImageMetadata, sketch_description: str):
     """Generator that uses ComfyUI to generate 3D object from user's sketch and description."""
-    img_meta = upload_image(image)
-    prompt_meta = queue_prompt(img_meta, sketch_description)
+    prompt_meta = await queue_prompt(img_meta, sketch_description)
 
     async for status in track_progress(prompt_meta.prompt_id):
         if isinstance(status, str):
@@ -59,13 +51,12 @@ async def generate_3d_prompt(image: Image.Image, sketch_description: str):
                 yield False, "An error occurred during generation."
                 return
 
-    await asyncio.sleep(1)
-    hist_data = get_history(prompt_meta.prompt_id)
+    hist_data = await wait_for_history(prompt_meta.prompt_id, COMFY_OUTPUT_GLB_NODE)
     filename = hist_data.outputs[COMFY_OUTPUT_GLB_NODE]["result"][0]
-    raw_file = get_file(filename, "3D", "output")
+    raw_file = await get_file(filename, "3D", "output")
     yield True, raw_file
 
 
-def create_3d_task(image: Image.Image, sketch_description: str):
-    """Create a task for generating a 3D object."""
-    return GenerationTask(generate_3d_prompt(image, sketch_description))
+def create_3d_task(img_meta: ImageMetadata, sketch_description: str):
+    """Create a task for generating a 3D object from an uploaded sketch."""
+    return GenerationTask(generate_3d_prompt(img_meta, sketch_description))
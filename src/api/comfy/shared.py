@@ -1,16 +1,17 @@
 """Shared stuff across both comfy workflows."""
 
 import asyncio
-import io
-import json
+import hashlib
 import logging
 import time
+from collections import OrderedDict
 from datetime import datetime
 from pathlib import Path
-from typing import Literal
+from typing import Any, Callable, Literal
+from uuid import uuid4
 
-import imagehash
-import requests
+import httpx
+import orjson
 from PIL import Image
 from pydantic import BaseModel, ValidationError
 from websockets.asyncio.client import connect
@@ -18,6 +19,7 @@ from websockets.exceptions import ConnectionClosed
 
 import src.api.comfy.prompts as prompts
 from src.api.comfy.msg_structs import ComfyUIMessageAdapter
+from src.utils import image_to_webp, run_in_image_pool
 
 log = logging.getLogger("app.api.comfy")
 
@@ -25,6 +27,44 @@ PROMPT_DIR = Path(prompts.__file__).parent.absolute()
 SERVER_ADDRESS = "http://nixrobo.home.arpa:8187"
 WS_ADDRESS = "ws://nixrobo.home.arpa:8187"
 CLIENT_ID = "literally_placeholder"
+# Backoff between history polls after ComfyUI reports completion.
+HISTORY_POLL_DELAYS = (0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+# Progress events are throttled to about this many per node run.
+PROGRESS_STEPS = 50
+# Number of recent uploads to remember, so resubmitted sketches skip the upload.
+UPLOAD_CACHE_SIZE = 256
+# Max tasks submitted to ComfyUI at once; the rest wait in NOT_STARTED.
+MAX_CONCURRENT_TASKS = 4
+# Fail task if ComfyUI goes silent for this long (seconds), e.g. stuck websocket.
+MSG_TIMEOUT = 600
+# Max wait (seconds) for the websocket to connect before submitting a prompt.
+WS_CONNECT_TIMEOUT = 30
+
+# Shared across all requests to ComfyUI so connections are kept alive & reused.
+http_client = httpx.AsyncClient(
+    base_url=SERVER_ADDRESS,
+    limits=httpx.Limits(
+        max_connections=64, max_keepalive_connections=32, keepalive_expiry=300
+    ),
+    timeout=httpx.Timeout(30.0),
+)
+
+
+def load_workflow(name: str) -> dict:
+    """Load workflow template from the prompts folder."""
+    return orjson.loads((PROMPT_DIR / name).read_bytes())
+
+
+def override_inputs(workflow: dict, overrides: dict[str, dict]) -> dict:
+    """Copy workflow with node inputs overridden, without mutating the original.
+
+    Only the overridden nodes are copied, the rest are shared with the template.
+    """
+    workflow = workflow.copy()
+    for node_id, inputs in overrides.items():
+        node = workflow[node_id]
+        workflow[node_id] = {**node, "inputs": {**node["inputs"], **inputs}}
+    return workflow
 
 
 class HistoryResponse(BaseModel):
@@ -52,97 +92,264 @@ class ImageMetadata(BaseModel):
     type: str
 
 
-async def track_progress(prompt_id: str):
-    """Generator that interprets ComfyUI's progress reports."""
-    async for ws in connect(f"{WS_ADDRESS}/ws?clientId={CLIENT_ID}"):
-        try:
-            async for raw in ws:
-                msg: dict = json.loads(raw)
-                try:
-                    m = ComfyUIMessageAdapter.validate_python(msg, strict=True)
-                # Don't reconnect on unknown msg type, just continue.
-                except ValidationError as e:
-                    log.error(f"Unknown message type: {msg}")
-                    yield f"Unknown msg: {msg}"
-                    continue
+# Keyed by content hash of the encoded image.
+upload_cache: OrderedDict[str, ImageMetadata] = OrderedDict()
+inflight_uploads: dict[str, asyncio.Task[ImageMetadata]] = {}
 
-                # Filter for only msg related to current prompt, but don't filter
-                # for general status messages.
-                if hasattr(m.data, "prompt_id") and m.data.prompt_id != prompt_id:  # type: ignore
-                    continue
 
-                # Below is based on the specific ComfyUI commit inside comfy_msg_structs.py.
-                if m.type == "status":
-                    yield f"Queue Remaining: {m.data.status.exec_info.queue_remaining - 1}"
-                elif m.type == "progress":
-                    yield f"Progress ({m.data.node}): {m.data.value}/{m.data.max}"
-                elif m.type == "executing":
-                    yield f"Executing Node: {m.data.node}"
-                elif m.type == "execution_cached":
-                    yield f"Cached Nodes: {', '.join(m.data.nodes)}"
-                # TODO: Possible to yield intermediate outputs here.
-                elif m.type == "executed":
-                    yield f"Executed Node: {m.data.node}"
-                elif m.type == "execution_start":
-                    yield f"Started: {m.data.prompt_id}"
-                elif m.type == "execution_success":
-                    yield f"Complete: {m.data.prompt_id}"
-                    yield True
-                    return
-
-            # Combined with continue on unknown msg type above, this should catch
-            # any case where the generation ends without a success message.
-            raise RuntimeError("Connection closed without generation completion?")
-        except ConnectionClosed:
-            log.warning("WebSocket connection closed, retrying...")
-            continue
-        # If json invalid, maybe connection issue so reconnect.
-        except json.JSONDecodeError as e:
-            log.error(f"Error decoding JSON message: {e}")
-            continue
-        except Exception as e:
-            log.error(f"Unexpected error (treat as fatal): {e}")
-            yield f"Error: {e}"
-            yield False
+# Below is based on the specific ComfyUI commit inside comfy_msg_structs.py.
+MSG_FORMATTERS: dict[str, Callable[[Any], str]] = {
+    "status": lambda d: f"Queue Remaining: {d.status.exec_info.queue_remaining - 1}",
+    "progress": lambda d: f"Progress ({d.node}): {d.value}/{d.max}",
+    "executing": lambda d: f"Executing Node: {d.node}",
+    "execution_cached": lambda d: f"Cached Nodes: {', '.join(d.nodes)}",
+    # TODO: Possible to yield intermediate outputs here.
+    "executed": lambda d: f"Executed Node: {d.node}",
+    "execution_start": lambda d: f"Started: {d.prompt_id}",
+    "execution_success": lambda d: f"Complete: {d.prompt_id}",
+}
+
+
+# Sentinel for messages that aren't tied to any prompt.
+_BROADCAST = object()
+
+
+class WSHub:
+    """Single websocket connection to ComfyUI shared by all generation tasks.
+
+    Messages are routed to per-prompt queues by their `prompt_id`, while general
+    messages (e.g. status) are broadcast to all of them.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self.queues: dict[str, asyncio.Queue] = {}
+        self.task = None
+        # Set while the websocket is open, since ComfyUI drops msgs sent before.
+        self.connected = asyncio.Event()
+
+    def register(self, prompt_id: str) -> asyncio.Queue:
+        """Get queue of messages for given prompt ID, connecting if needed."""
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+            self.task.add_done_callback(self._on_done)
+        return self.queues.setdefault(prompt_id, asyncio.Queue())
+
+    async def wait_connected(self):
+        """Wait until the websocket is open, so no messages are missed."""
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout=WS_CONNECT_TIMEOUT)
+        except TimeoutError:
+            raise RuntimeError(
+                f"Could not connect to ComfyUI websocket in {WS_CONNECT_TIMEOUT}s."
+            )
+
+    def unregister(self, prompt_id: str):
+        """Stop routing messages for given prompt ID."""
+        self.queues.pop(prompt_id, None)
+
+    def _route(self, prompt_id, item):
+        """Put item in the queue for prompt_id, or all queues if there is none."""
+        if prompt_id is _BROADCAST:
+            for q in self.queues.values():
+                q.put_nowait(item)
+        elif prompt_id in self.queues:
+            self.queues[prompt_id].put_nowait(item)
+
+    def _on_done(self, task: asyncio.Task):
+        """Fail tracked prompts if the hub dies, e.g. non-retryable connect error."""
+        self.connected.clear()
+        if task.cancelled() or task.exception() is None:
             return
+        e = task.exception()
+        log.error(f"WebSocket hub stopped: {e}", exc_info=e)
+        self._route(_BROADCAST, e)
+
+    async def _run(self):
+        """Read messages from ComfyUI forever, reconnecting as needed."""
+        async for ws in connect(f"{WS_ADDRESS}/ws?clientId={CLIENT_ID}"):
+            self.connected.set()
+            try:
+                async for raw in ws:
+                    msg = orjson.loads(raw)
+                    # Skip validating msgs for prompts nobody is tracking. Malformed
+                    # frames fall through to validation and are reported below.
+                    data = msg.get("data") if isinstance(msg, dict) else None
+                    pid = data.get("prompt_id") if isinstance(data, dict) else None
+                    if pid is not None and pid not in self.queues:
+                        continue
+                    try:
+                        m = ComfyUIMessageAdapter.validate_python(msg, strict=True)
+                    # Don't reconnect on unknown msg type, just continue.
+                    except ValidationError:
+                        log.error(f"Unknown message type: {msg}")
+                        self._route(_BROADCAST if pid is None else pid, msg)
+                        continue
+
+                    # Route msg related to a specific prompt, but broadcast general
+                    # status messages.
+                    self._route(getattr(m.data, "prompt_id", _BROADCAST), m)
+            except ConnectionClosed:
+                log.warning("WebSocket connection closed, retrying...")
+                continue
+            # If json invalid, maybe connection issue so reconnect.
+            except orjson.JSONDecodeError as e:
+                log.error(f"Error decoding JSON message: {e}")
+                continue
+            # Fatal for the tasks in flight, but keep the hub alive for later ones.
+            except Exception as e:
+                log.error(f"Unexpected error (treat as fatal): {e}")
+                self._route(_BROADCAST, e)
+                continue
+            finally:
+                self.connected.clear()
+
+
+ws_hub = WSHub()
+
+
+async def track_progress(prompt_id: str):
+    """Generator that interprets ComfyUI's progress reports."""
+    # Already registered by submit_prompt, so this returns the queue with any
+    # messages that arrived early.
+    q = ws_hub.register(prompt_id)
+    # Last reported progress value per node, used to throttle progress events.
+    last_progress: dict[str, int] = {}
+    try:
+        while True:
+            m = await q.get()
+            if isinstance(m, Exception):
+                yield f"Error: {m}"
+                yield False
+                return
+            # Raw frames that failed validation (not necessarily dicts).
+            if not isinstance(m, BaseModel):
+                yield f"Unknown msg: {m}"
+                continue
+
+            msg_type = m.type
+            if msg_type == "progress":
+                d = m.data
+                # Skip small increments, but always report the first, last & restarts.
+                step = d.value - last_progress.get(d.node, -d.max)
+                if d.value != d.max and 0 <= step < d.max // PROGRESS_STEPS:
+                    continue
+                last_progress[d.node] = d.value
+            yield MSG_FORMATTERS[msg_type](m.data)
+            if msg_type == "execution_success":
+                yield True
+                return
+    finally:
+        ws_hub.unregister(prompt_id)
+
+
+async def submit_prompt(prompt: dict):
+    """Submit a workflow to ComfyUI's queue, tracking its messages from the start."""
+    # Pick the prompt ID ourselves and wait for the websocket, so the queue exists
+    # before ComfyUI can send anything, e.g. execution_success for a fully cached
+    # workflow.
+    prompt_id = str(uuid4())
+    ws_hub.register(prompt_id)
+    try:
+        await ws_hub.wait_connected()
+        data = orjson.dumps(
+            {"prompt": prompt, "client_id": CLIENT_ID, "prompt_id": prompt_id}
+        )
+        headers = {"Content-Type": "application/json"}
+        resp = await http_client.post("/prompt", content=data, headers=headers)
+        obj = PromptQueueResponse.model_validate_json(resp.content)
+        if obj.prompt_id != prompt_id:
+            raise RuntimeError(
+                f"ComfyUI ignored prompt ID {prompt_id}, queued as {obj.prompt_id}."
+            )
+    except BaseException:
+        ws_hub.unregister(prompt_id)
+        raise
+    return obj
 
 
-def get_history(prompt_id: str):
+async def get_history(prompt_id: str):
     """Get workflow history (and hence results) for given prompt ID."""
-    resp = requests.get(f"{SERVER_ADDRESS}/history/{prompt_id}")
-    obj = resp.json()
+    resp = await http_client.get(f"/history/{prompt_id}")
+    obj = orjson.loads(resp.content)
     obj = HistoryResponse.model_validate(obj[prompt_id])
     return obj
 
 
-def get_file(filename: str, subfolder: str, folder_type: str):
+async def wait_for_history(prompt_id: str, output_node: str):
+    """Poll workflow history until the given output node's result is available."""
+    for delay in HISTORY_POLL_DELAYS:
+        try:
+            obj = await get_history(prompt_id)
+            if output_node in obj.outputs:
+                return obj
+        # History isn't written yet.
+        except KeyError:
+            pass
+        await asyncio.sleep(delay)
+    try:
+        obj = await get_history(prompt_id)
+    except KeyError:
+        raise RuntimeError(f"No history for prompt {prompt_id} after polling.")
+    if output_node not in obj.outputs:
+        raise RuntimeError(f"No output from node {output_node} for prompt {prompt_id}.")
+    return obj
+
+
+async def get_file(filename: str, subfolder: str, folder_type: str):
     """Get a file from ComfyUI's storage."""
     params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-    resp = requests.get(f"{SERVER_ADDRESS}/view", params=params)
-    return resp.content
+    # Outputs can be tens of MB, so fill a single buffer rather than joining chunks.
+    buf = bytearray()
+    async with http_client.stream("GET", "/view", params=params) as resp:
+        async for chunk in resp.aiter_bytes(1 << 16):
+            buf.extend(chunk)
+    return buf
 
 
-def upload_image(image: Image.Image):
-    """Upload an image to ComfyUI's storage."""
-    buf = io.BytesIO()
-    image.save(buf, format="webp", quality=100)
-    buf.seek(0)
-    filename = f"{imagehash.phash(image, hash_size=16)}.webp"
-
-    files = {"image": (filename, buf, "image/webp")}
+async def post_image(filename: str, img_bytes: bytes):
+    """Post encoded image to ComfyUI's input folder."""
+    files = {"image": (filename, img_bytes, "image/webp")}
     data = {"type": "input", "overwrite": "false"}
-    url = f"{SERVER_ADDRESS}/upload/image"
-    resp = requests.post(url, files=files, data=data)
+    resp = await http_client.post("/upload/image", files=files, data=data)
 
     obj = ImageMetadata.model_validate_json(resp.content)
     return obj
 
 
+async def upload_image(image: Image.Image):
+    """Upload an image to ComfyUI's storage."""
+    # ComfyUI rasterizes the sketch anyway, so favour encode speed over quality.
+    img_bytes = await run_in_image_pool(image_to_webp, image, quality=85, method=0)
+    # Filename is only used to dedupe uploads, so exact content hash is enough.
+    digest = hashlib.blake2b(img_bytes, digest_size=16).hexdigest()
+
+    if digest in upload_cache:
+        upload_cache.move_to_end(digest)
+        return upload_cache[digest]
+
+    # Concurrent uploads of the same image (e.g. double submit) share one request.
+    task = inflight_uploads.get(digest)
+    if task is None:
+        task = asyncio.create_task(post_image(f"{digest}.webp", img_bytes))
+        task.add_done_callback(lambda _: inflight_uploads.pop(digest, None))
+        inflight_uploads[digest] = task
+    obj = await asyncio.shield(task)
+
+    upload_cache[digest] = obj
+    if len(upload_cache) > UPLOAD_CACHE_SIZE:
+        upload_cache.popitem(last=False)
+    return obj
+
+
 # TODO: pretty limited; if we can parse the workflow events more accurately, this
 # can be more useful.
 TaskStatus = Literal["NOT_STARTED", "IN_PROGRESS", "COMPLETED", "FAILED"]
 
 
+task_slots = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
+
+
 class GenerationTask:
     """Class to manage a generation task."""
 
@@ -151,6 +358,8 @@ class GenerationTask:
         self.generator = generator
         self.event_log = []
         self.status: TaskStatus = "NOT_STARTED"
+        # Set (and replaced) whenever there are new events or the task finishes.
+        self.updated = asyncio.Event()
         self.task = None
         self.timestamp = None
         self.duration = None
@@ -160,8 +369,41 @@ class GenerationTask:
         """Start the generation task."""
         self.task = asyncio.create_task(self._process())
 
+    def events_since(self, n: int):
+        """Get events logged after the first `n` events."""
+        return self.event_log[n:]
+
+    async def stream_events(self, n: int = 0, keepalive: float | None = None):
+        """Generator of events logged after the first `n`, until the task finishes.
+
+        If `keepalive` is given, None is yielded whenever there are no new events
+        for that many seconds.
+        """
+        while True:
+            # Grab before checking so updates in between aren't missed.
+            updated = self.updated
+            while n < len(self.event_log):
+                yield self.event_log[n]
+                n += 1
+            if self.status in ("COMPLETED", "FAILED"):
+                return
+            try:
+                await asyncio.wait_for(updated.wait(), timeout=keepalive)
+            except TimeoutError:
+                yield None
+
+    def _notify(self):
+        """Wake up any event streams."""
+        self.updated.set()
+        self.updated = asyncio.Event()
+
     async def _process(self):
         """Process task."""
+        async with task_slots:
+            return await self._consume()
+
+    async def _consume(self):
+        """Consume generator, logging events until the raw file is received."""
         self.status = "IN_PROGRESS"
         self.timestamp = datetime.now()
 
@@ -169,27 +411,41 @@ class GenerationTask:
         start_time = time.monotonic()
 
         try:
-            async for done, msg in self.generator:
+            while True:
+                try:
+                    done, msg = await asyncio.wait_for(
+                        anext(self.generator), timeout=MSG_TIMEOUT
+                    )
+                # Generator ends without yielding done=True, indicating an error.
+                except StopAsyncIteration:
+                    raise RuntimeError("Comfyui stopped without completion.")
+                except TimeoutError:
+                    raise RuntimeError(f"No update from Comfyui in {MSG_TIMEOUT}s.")
+
                 if not done:
                     self.event_log.append(msg)
+                    self._notify()
                 else:
-                    assert isinstance(msg, bytes), "Expected raw file data."
+                    assert isinstance(msg, (bytes, bytearray)), (
+                        "Expected raw file data."
+                    )
                     raw_file = msg
                     break
-            # Loop completes without yielding done=True, indicating an error.
-            else:
-                raise RuntimeError("Comfyui stopped without completion.")
 
         except Exception as e:
             self.error = e
             self.status = "FAILED"
             self.event_log.append(f"Error: {e}")
+            self._notify()
             self.duration = time.monotonic() - start_time
             log.error(f"Generation task failed: {e}", exc_info=e)
             return None
+        finally:
+            await self.generator.aclose()
 
         self.status = "COMPLETED"
         self.duration = time.monotonic() - start_time
+        self._notify()
         return raw_file
 
     async def result(self):
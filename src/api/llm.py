@@ -2,17 +2,20 @@
 
 from __future__ import annotations
 
-import asyncio
-import io
+import hashlib
 import json
 import logging
 import os
 
+import httpx
+from cachetools import TTLCache
 from google import genai
 from google.genai import types
 from PIL import Image
 from pydantic import BaseModel
 
+from src.utils import image_to_jpg, run_in_image_pool
+
 log = logging.getLogger("app.api.ai")
 
 # Placeholder model - update with actual Google GenAI model
@@ -20,6 +23,19 @@ AI_MODEL = "gemini-2.5-flash-lite"
 
 EMERGENCY_BYPASS = False
 
+# Image is only sent once to the VLM, so favour encode speed (JPEG is much faster
+# to encode than WebP) over size or fidelity. The VLM downsamples large images
+# anyways, so no point encoding them at full resolution.
+JPG_SAVE_KWARGS = {"quality": 80, "max_side": 1024}
+
+# Uploads in these formats that are small enough are sent to the VLM as-is.
+PASSTHROUGH_MIME_TYPES = {"image/jpeg", "image/png", "image/webp"}
+PASSTHROUGH_MAX_BYTES = 1 << 20
+
+# Users tend to retry & iterate on the same inputs, so reuse results for those.
+describe_cache: TTLCache[tuple[str, str], str] = TTLCache(maxsize=1024, ttl=3600)
+expand_cache: TTLCache[str, tuple[str, str]] = TTLCache(maxsize=1024, ttl=3600)
+
 
 def ai_create_client():
     """Initialize AI client."""
@@ -27,7 +43,16 @@ def ai_create_client():
     if not api_key:
         raise ValueError("GOOGLE_GENAI_API_KEY environment variable is not set.")
 
-    return genai.Client(api_key=api_key)
+    # Keep connections to the API alive across requests instead of redoing TLS.
+    http_options = types.HttpOptions(
+        async_client_args={
+            "http2": True,
+            "limits": httpx.Limits(
+                max_connections=128, max_keepalive_connections=64, keepalive_expiry=300
+            ),
+        }
+    )
+    return genai.Client(api_key=api_key, http_options=http_options)
 
 
 class SketchPrompt(BaseModel):
@@ -52,38 +77,49 @@ OBJ_GEN_PROMPT_EXAMPLES = [
     "3D Product render style, futuristic lamp, finely detailed, purism, ue 5, a computer rendering, minimalism, octane render, 4k",
 ]
 
+# Static part of the prompt is only rendered once. It is kept as the prefix, with
+# user input appended after, so the LLM provider can reuse it across requests.
+OBJ_GEN_PROMPT_PREFIX = f"""\
+Example prompts for an AI art model specialized in Product Design renders:
+{"\n".join(f" - {example}" for example in OBJ_GEN_PROMPT_EXAMPLES)}
+
+Given the user's sketch image, your task is to output a prompt for the AI art model. Use the following schema:
+{json.dumps(SketchPrompt.model_json_schema())}\
+"""
+
 
 async def ai_describe_image(
     client: genai.Client, image: Image.Image, description: str | None = None
 ):
     """Generate prompt based off user's sketch and description."""
+    img_bytes = await run_in_image_pool(image_to_jpg, image, **JPG_SAVE_KWARGS)
+    return await ai_describe_image_bytes(client, img_bytes, "image/jpeg", description)
+
+
+async def ai_describe_image_bytes(
+    client: genai.Client,
+    img_bytes: bytes,
+    mime_type: str,
+    description: str | None = None,
+):
+    """Same as `ai_describe_image`, but for an already encoded image."""
     if EMERGENCY_BYPASS:
         return f"3D product render, futuristic {description}, finely detailed, purism, ue 5, a computer rendering, minimalism, octane render, 4k"
 
-    buf = io.BytesIO()
-    await asyncio.to_thread(image.save, buf, format="webp", quality=70)
-    img_bytes = buf.getvalue()
-    buf.close()
-
-    prompt = f"""\
-Example prompts for an AI art model specialized in Product Design renders:
-{"\n".join(f" - {example}" for example in OBJ_GEN_PROMPT_EXAMPLES)}\
-"""
+    img_hash = hashlib.blake2b(img_bytes, digest_size=16).hexdigest()
+    cache_key = (img_hash, (description or "").strip())
+    if (cached := describe_cache.get(cache_key)) is not None:
+        return cached
 
+    prompt = OBJ_GEN_PROMPT_PREFIX
     if description is not None and description.strip() != "":
         prompt += f"\n\nTake into consideration the user's description of their sketch:\n{description}"
 
-    prompt += f"""
-
-Given the user's sketch image, your task is to output a prompt for the AI art model. Use the following schema:
-{json.dumps(SketchPrompt.model_json_schema())}\
-"""
-
     resp = await client.aio.models.generate_content(
         model=AI_MODEL,
         contents=[
             prompt,
-            types.Part.from_bytes(data=img_bytes, mime_type="image/webp"),
+            types.Part.from_bytes(data=img_bytes, mime_type=mime_type),
         ],
         config=types.GenerateContentConfig(
             response_mime_type="application/json",
@@ -91,10 +127,11 @@ Given the user's sketch image, your task is to output a prompt for the AI art mo
         ),
     )
 
-    log.info(f"PROMPT:\n{prompt}")
+    log.debug(f"PROMPT:\n{prompt}")
     log.info(f"RESPONSE:\n{resp.text}")
 
     obj: SketchPrompt = resp.parsed  # type: ignore
+    describe_cache[cache_key] = obj.prompt
     return obj.prompt
 
 
@@ -111,16 +148,8 @@ HDRI_GEN_CLIP_PROMPT_EXAMPLES = [
 ]
 
 
-# NOTE: Model page says to avoid saying "spherical projection" since that tends to result in non-equirectangular spherical images.
-async def ai_expand_prompt(client: genai.Client, prompt: str):
-    """Expand the prompt for T5 and CLIP models."""
-    if EMERGENCY_BYPASS:
-        return (
-            f"equirectangular 360 degree panorama {prompt}",
-            f"equirectangular 360 degree panorama {prompt}",
-        )
-
-    system_prompt = f"""\
+# Same as above, static prefix is rendered once and shared across requests.
+HDRI_GEN_PROMPT_PREFIX = f"""\
 Example T5 prompts for HDRI environment generation (natural prose style):
 {"\n".join(f" - {example}" for example in HDRI_GEN_T5_PROMPT_EXAMPLES)}
 
@@ -134,11 +163,26 @@ Your task is to expand the user's prompt into two different versions for HDRI en
 
 Both prompts MUST start with "Equirectangular 360 degree panorama" (T5) or "equirectangular 360 degree panorama" (CLIP). Avoid using "spherical projection" as that tends to result in non-equirectangular images. Both prompts should describe the same scene/environment but in their respective styles.
 
-User's prompt: {prompt}
-
 Generate both expanded prompts in JSON format with the following schema:
-{json.dumps(HdriPrompts.model_json_schema())}\
-"""
+{json.dumps(HdriPrompts.model_json_schema())}
+
+User's prompt: """
+
+
+# NOTE: Model page says to avoid saying "spherical projection" since that tends to result in non-equirectangular spherical images.
+async def ai_expand_prompt(client: genai.Client, prompt: str):
+    """Expand the prompt for T5 and CLIP models."""
+    if EMERGENCY_BYPASS:
+        return (
+            f"equirectangular 360 degree panorama {prompt}",
+            f"equirectangular 360 degree panorama {prompt}",
+        )
+
+    cache_key = prompt.strip().lower()
+    if (cached := expand_cache.get(cache_key)) is not None:
+        return cached
+
+    system_prompt = HDRI_GEN_PROMPT_PREFIX + prompt
 
     resp = await client.aio.models.generate_content(
         model=AI_MODEL,
@@ -149,8 +193,9 @@ Generate both expanded prompts in JSON format with the following schema:
         ),
     )
 
-    log.info(f"PROMPT:\n{system_prompt}")
+    log.debug(f"PROMPT:\n{system_prompt}")
     log.info(f"RESPONSE:\n{resp.text}")
 
     obj: HdriPrompts = resp.parsed  # type: ignore
+    expand_cache[cache_key] = obj.t5_prompt, obj.clip_prompt
     return obj.t5_prompt, obj.clip_prompt
@@ -1,21 +1,32 @@
 """Main app."""
 
 import asyncio
+import io
 import logging
 from pathlib import Path
-from typing import Annotated, Dict
+from typing import Annotated
 from uuid import uuid4
 
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from fastapi import FastAPI, Form, HTTPException
+from fastapi import FastAPI, Form, Header, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from PIL import Image
 
 from src.api.comfy.hdri import create_hdri_task
 from src.api.comfy.obj import create_3d_task
-from src.api.comfy.shared import GenerationTask
-from src.api.llm import ai_create_client, ai_describe_image, ai_expand_prompt
+from src.api.comfy.shared import GenerationTask, upload_image
+from src.api.llm import (
+    JPG_SAVE_KWARGS,
+    PASSTHROUGH_MAX_BYTES,
+    PASSTHROUGH_MIME_TYPES,
+    ai_create_client,
+    ai_describe_image,
+    ai_describe_image_bytes,
+    ai_expand_prompt,
+)
 from src.structs import (
     RequestGenerate3D,
     RequestGenerateHDRI,
@@ -27,7 +38,7 @@ from src.structs import (
     ResponseGenerationResult,
     ResponseGenerationStatus,
 )
-from src.utils import png_to_jpg
+from src.utils import png_to_jpg, run_in_image_pool, save_file
 
 load_dotenv()
 
@@ -37,21 +48,30 @@ __all__ = ["create_app"]
 log = logging.getLogger("app")
 
 HOST_URL = "https://recovr.interpause.dev"
+# Tasks (and their results) are forgotten after this long (seconds).
+TASK_TTL = 3600
+TASK_CACHE_SIZE = 10_000
+# Idle SSE streams get a comment this often (seconds) so proxies don't drop them.
+SSE_KEEPALIVE = 15
 
 # TODO:
-# - Setup websocket/SSE/streaming response version of events so client don't have to poll server for updates.
 # - Implement the generation of 3D content using an Action model like ROS2 Actions. (cant stop tasks atm)
 # - How to disable comfyui saving outputs, or delete them?
 # - An actual user/security system: https://fastapi.tiangolo.com/tutorial/security/get-current-user/
 #   - So how do we secure a cloud bucket with user permissions?
 
 
+def sse_data(msg: str):
+    """Format message as SSE data field(s)."""
+    return "".join(f"data: {line}\n" for line in msg.splitlines() or [""])
+
+
 def create_app():
     """App factory.
 
     Creating the app within a function prevents mishaps if using multiprocessing.
     """
-    app = FastAPI()
+    app = FastAPI(default_response_class=ORJSONResponse)
 
     # Add CORS middleware to allow all origins
     app.add_middleware(
@@ -63,99 +83,163 @@ def create_app():
     )
 
     ai_client = ai_create_client()
-    # Map of client to map of task id to GenerationTask.
-    workflow_tasks: Dict[str, Dict[str, GenerationTask]] = {}
+    # Map of "{client_id}:{task_id}" to GenerationTask. Old tasks are evicted so
+    # results held in memory don't pile up on long-lived servers.
+    workflow_tasks: TTLCache[str, GenerationTask] = TTLCache(
+        maxsize=TASK_CACHE_SIZE, ttl=TASK_TTL
+    )
 
     app.mount("/static", StaticFiles(directory="public"), name="static")
 
+    def get_task(client_id: str, task_id: str):
+        """Get task, raising 404 if it doesn't exist."""
+        task = workflow_tasks.get(f"{client_id}:{task_id}")
+        if not task:
+            raise HTTPException(status_code=404, detail=f"Task {task_id} not found.")
+        return task
+
+    def start_task(client_id: str, task_id: str, task: GenerationTask):
+        """Store & start task."""
+        key = f"{client_id}:{task_id}"
+        workflow_tasks[key] = task
+        task.start()
+        # Re-set once finished, so results are kept for TASK_TTL after completion
+        # rather than submission.
+        task.task.add_done_callback(lambda _: workflow_tasks.__setitem__(key, task))
+
+    def add_task_routes(prefix: str, kind: str, ext: str, convert=None):
+        """Add the status, events & result endpoints for a workflow.
+
+        These only take a few small strings, so they use query params rather than
+        multipart forms to skip form parsing on every poll.
+
+        Args:
+            prefix: Route prefix of the workflow.
+            kind: Folder results are saved under.
+            ext: File extension of saved results.
+            convert: Optional function to convert the raw result before saving.
+        """
+
+        @app.post(f"/{prefix}/get_status")
+        async def check_status(
+            req: Annotated[RequestGenerationStatus, Query()],
+        ) -> ResponseGenerationStatus:
+            """Endpoint to check the status of workflow."""
+            task = get_task(req.client_id, req.task_id)
+            return ResponseGenerationStatus(status=task.status)
+
+        @app.post(f"/{prefix}/get_events")
+        async def get_events(
+            req: Annotated[RequestGenerationEvents, Query()],
+        ) -> ResponseGenerationEvents:
+            """Endpoint to get workflow events."""
+            task = get_task(req.client_id, req.task_id)
+            return ResponseGenerationEvents(
+                events=task.events_since(req.n_received), n_received=len(task.event_log)
+            )
+
+        @app.get(f"/{prefix}/events/{{client_id}}/{{task_id}}")
+        async def stream_events(
+            client_id: str,
+            task_id: str,
+            n_received: Annotated[int, Query(ge=0)] = 0,
+            last_event_id: Annotated[
+                int | None, Header(alias="Last-Event-ID", ge=0)
+            ] = None,
+        ) -> StreamingResponse:
+            """Endpoint to stream workflow events as Server-Sent Events.
+
+            Browsers resume with the `Last-Event-ID` header on reconnect, which takes
+            precedence over `n_received`.
+            """
+            task = get_task(client_id, task_id)
+
+            async def sse():
+                n = n_received if last_event_id is None else last_event_id
+                async for event in task.stream_events(n, keepalive=SSE_KEEPALIVE):
+                    if event is None:
+                        yield ": keepalive\n\n"
+                        continue
+                    n += 1
+                    # Event id is the n_received to resume from.
+                    yield f"id: {n}\n{sse_data(event)}\n"
+                yield f"event: status\n{sse_data(task.status)}\n"
+
+            headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            return StreamingResponse(
+                sse(), media_type="text/event-stream", headers=headers
+            )
+
+        # NOTE: As a side effect, results are only saved by the gateway if the user
+        # requests it. ComfyUI still saves it tho but the filename gets lost.
+        @app.post(f"/{prefix}/get_result")
+        async def get_result(
+            req: Annotated[RequestGenerationResult, Query()],
+        ) -> ResponseGenerationResult:
+            """Endpoint to get the result of workflow."""
+            client_id = req.client_id
+            task_id = req.task_id
+            task = get_task(client_id, task_id)
+
+            # if task.status != "COMPLETED":
+            #     raise HTTPException(
+            #         status_code=400, detail="Task is not completed yet.")
+
+            raw_file = await task.result()
+            if raw_file is None:
+                return ResponseGenerationResult(success=False)
+            if convert is not None:
+                raw_file = await run_in_image_pool(convert, raw_file)
+
+            filename = f"{task_id}.{ext}"
+            out_path = Path("public") / "generated" / client_id / kind / filename
+            # TODO: It shouldnt store this locally, rather to some cloud bucket...
+            await asyncio.to_thread(save_file, out_path, raw_file)
+
+            url = f"{HOST_URL}/static/generated/{client_id}/{kind}/{filename}"
+            return ResponseGenerationResult(success=True, url=url)
+
     @app.post("/3d_obj/add_task")
     async def add_obj_task(
         req: Annotated[RequestGenerate3D, Form(..., media_type="multipart/form-data")],
     ) -> ResponseGenerateTask:
         """Endpoint to generate 3D model from user's sketch and description."""
-        image = Image.open(req.image.file)
-        await asyncio.to_thread(image.load)  # Ensure the image is loaded in the thread
+        raw = await req.image.read()
+        image = Image.open(io.BytesIO(raw))
+        await run_in_image_pool(image.load)  # Ensure the image is loaded in the thread
         client_id = req.client_id
 
-        prompt = await ai_describe_image(ai_client, image, req.prompt)
+        # Skip re-encoding for the LLM if it can take the upload as-is. Go by the
+        # decoded format, since the client's content type can't be trusted. Images
+        # with transparency or above the size cap still need image_to_jpg.
+        mime_type = Image.MIME.get(image.format)
+        passthrough = (
+            mime_type in PASSTHROUGH_MIME_TYPES
+            and len(raw) <= PASSTHROUGH_MAX_BYTES
+            and image.mode not in ("RGBA", "LA", "P")
+            and max(image.size) <= JPG_SAVE_KWARGS["max_side"]
+        )
+        if passthrough:
+            describe_coro = ai_describe_image_bytes(
+                ai_client, raw, mime_type, req.prompt
+            )
+        else:
+            describe_coro = ai_describe_image(ai_client, image, req.prompt)
+
+        # Upload sketch to ComfyUI while waiting on the LLM.
+        async with asyncio.TaskGroup() as tg:
+            upload = tg.create_task(upload_image(image))
+            describe = tg.create_task(describe_coro)
+        img_meta, prompt = upload.result(), describe.result()
 
-        tasks = workflow_tasks.setdefault(client_id, {})
         task_id = uuid4().hex
-        task = create_3d_task(image, prompt.strip())
-        tasks[task_id] = task
-
-        task.start()
+        task = create_3d_task(img_meta, prompt.strip())
+        start_task(client_id, task_id, task)
         log.info(f"Started obj task {task_id} for client {client_id}.")
 
         return ResponseGenerateTask(task_id=task_id)
 
-    @app.post("/3d_obj/get_status")
-    async def check_obj_status(
-        req: Annotated[RequestGenerationStatus, Form()],
-    ) -> ResponseGenerationStatus:
-        """Endpoint to check the status of obj workflow."""
-        client_id = req.client_id
-        task_id = req.task_id
-
-        tasks = workflow_tasks.get(client_id, {})
-        task = tasks.get(task_id)
-
-        if not task:
-            raise HTTPException(status_code=404, detail=f"Task {task_id} not found.")
-
-        return ResponseGenerationStatus(status=task.status)
-
-    @app.post("/3d_obj/get_events")
-    async def get_obj_events(
-        req: Annotated[RequestGenerationEvents, Form()],
-    ) -> ResponseGenerationEvents:
-        """Endpoint to get obj workflow events."""
-        client_id = req.client_id
-        task_id = req.task_id
-        n_received = req.n_received
-
-        tasks = workflow_tasks.get(client_id, {})
-        task = tasks.get(task_id)
-
-        if not task:
-            raise HTTPException(status_code=404, detail=f"Task {task_id} not found.")
-
-        return ResponseGenerationEvents(
-            events=task.event_log[n_received:], n_received=len(task.event_log)
-        )
-
-    # NOTE: As a side effect, results are only saved by the gateway if the user
-    # requests it. ComfyUI still saves it tho but the filename gets lost.
-    @app.post("/3d_obj/get_result")
-    async def get_obj_result(
-        req: Annotated[RequestGenerationResult, Form()],
-    ) -> ResponseGenerationResult:
-        """Endpoint to get the result of obj workflow."""
-        client_id = req.client_id
-        task_id = req.task_id
-
-        tasks = workflow_tasks.get(client_id, {})
-        task = tasks.get(task_id)
-
-        if not task:
-            raise HTTPException(status_code=404, detail=f"Task {task_id} not found.")
-
-        # if task.status != "COMPLETED":
-        #     raise HTTPException(
-        #         status_code=400, detail="Task is not completed yet.")
-
-        raw_file = await task.result()
-        if raw_file is None:
-            return ResponseGenerationResult(success=False)
-
-        out_path = Path("public") / "generated" / client_id / "obj" / f"{task_id}.glb"
-        out_path.parent.mkdir(parents=True, exist_ok=True)
-        # TODO: It shouldnt store this locally, rather to some cloud bucket...
-        with open(out_path, "wb") as f:
-            f.write(raw_file)
-
-        url = f"{HOST_URL}/static/generated/{client_id}/obj/{task_id}.glb"
-        return ResponseGenerationResult(success=True, url=url)
+    add_task_routes("3d_obj", "obj", "glb")
 
     @app.post("/hdri/add_task")
     async def add_hdri_task(
@@ -168,84 +252,13 @@ def create_app():
 
         t5_prompt, clip_prompt = await ai_expand_prompt(ai_client, req.prompt)
 
-        tasks = workflow_tasks.setdefault(client_id, {})
         task_id = uuid4().hex
         task = create_hdri_task(t5_prompt.strip(), clip_prompt.strip())
-        tasks[task_id] = task
-
-        task.start()
+        start_task(client_id, task_id, task)
         log.info(f"Started hdri task {task_id} for client {client_id}.")
 
         return ResponseGenerateTask(task_id=task_id)
 
-    # TODO: Literally the same implementation, how to unify?
-    @app.post("/hdri/get_status")
-    async def check_hdri_status(
-        req: Annotated[RequestGenerationStatus, Form()],
-    ) -> ResponseGenerationStatus:
-        """Endpoint to check the status of hdri workflow."""
-        client_id = req.client_id
-        task_id = req.task_id
-
-        tasks = workflow_tasks.get(client_id, {})
-        task = tasks.get(task_id)
-
-        if not task:
-            raise HTTPException(status_code=404, detail=f"Task {task_id} not found.")
-
-        return ResponseGenerationStatus(status=task.status)
-
-    @app.post("/hdri/get_events")
-    async def get_hdri_events(
-        req: Annotated[RequestGenerationEvents, Form()],
-    ) -> ResponseGenerationEvents:
-        """Endpoint to get hdri workflow events."""
-        client_id = req.client_id
-        task_id = req.task_id
-        n_received = req.n_received
-
-        tasks = workflow_tasks.get(client_id, {})
-        task = tasks.get(task_id)
-
-        if not task:
-            raise HTTPException(status_code=404, detail=f"Task {task_id} not found.")
-
-        return ResponseGenerationEvents(
-            events=task.event_log[n_received:], n_received=len(task.event_log)
-        )
-
-    # NOTE: As a side effect, results are only saved by the gateway if the user
-    # requests it. ComfyUI still saves it tho but the filename gets lost.
-    @app.post("/hdri/get_result")
-    async def get_hdri_result(
-        req: Annotated[RequestGenerationResult, Form()],
-    ) -> ResponseGenerationResult:
-        """Endpoint to get the result of hdri workflow."""
-        client_id = req.client_id
-        task_id = req.task_id
-
-        tasks = workflow_tasks.get(client_id, {})
-        task = tasks.get(task_id)
-
-        if not task:
-            raise HTTPException(status_code=404, detail=f"Task {task_id} not found.")
-
-        # if task.status != "COMPLETED":
-        #     raise HTTPException(
-        #         status_code=400, detail="Task is not completed yet.")
-
-        raw_file = await task.result()
-        if raw_file is None:
-            return ResponseGenerationResult(success=False)
-        raw_file = await asyncio.to_thread(png_to_jpg, raw_file)
-
-        out_path = Path("public") / "generated" / client_id / "hdri" / f"{task_id}.jpg"
-        out_path.parent.mkdir(parents=True, exist_ok=True)
-        # TODO: It shouldnt store this locally, rather to some cloud bucket...
-        with open(out_path, "wb") as f:
-            f.write(raw_file)
-
-        url = f"{HOST_URL}/static/generated/{client_id}/hdri/{task_id}.jpg"
-        return ResponseGenerationResult(success=True, url=url)
+    add_task_routes("hdri", "hdri", "jpg", convert=png_to_jpg)
 
     return app
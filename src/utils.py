@@ -1,7 +1,12 @@
 """Utility functions for the SDS API Gateway."""
 
+import asyncio
+import functools
 import io
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import av
 import numpy as np
@@ -9,6 +14,17 @@ from PIL import Image
 
 log = logging.getLogger("app.utils")
 
+# CPU-bound image work gets its own pool so it doesn't contend with IO in to_thread.
+image_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="image")
+
+
+async def run_in_image_pool(func, *args, **kwargs):
+    """Run CPU-bound image function in the dedicated image pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        image_pool, functools.partial(func, *args, **kwargs)
+    )
+
 
 def np_wav_to_compressed_buffer(sample_rate: int, wav: np.ndarray):
     """Compress raw audio and store inside a file buffer."""
@@ -16,10 +32,12 @@ def np_wav_to_compressed_buffer(sample_rate: int, wav: np.ndarray):
     assert wav.dtype == np.int16
     # Mono without channel dim.
     if wav.ndim == 1:
-        wav = np.tile(wav[:, None], (1, 2))
-    # mono with channel dim.
-    elif wav.ndim == 2 and wav.shape[1] == 1:
-        wav = np.tile(wav, (1, 2))
+        wav = wav[:, None]
+    n_channels = wav.shape[1]
+    layout = "mono" if n_channels == 1 else "stereo"
+    # (samples, channels) is already interleaved, which is what packed s16 wants,
+    # so flatten once instead of transposing to planar per frame.
+    packed = np.ascontiguousarray(wav).reshape(1, -1)
 
     # Groq downsamples to 16kHz mono, so we compress to that to save bandwidth.
     # Balance between file size (upload speed) and decode latency.
@@ -30,19 +48,23 @@ def np_wav_to_compressed_buffer(sample_rate: int, wav: np.ndarray):
     buf = io.BytesIO()
     frame_size = sample_rate // 1000 * frame_size
     container = av.open(buf, mode="w", format="ogg")
-    resampler = av.AudioResampler(
-        format="s16", layout="mono", rate=out_rate, frame_size=frame_size
-    )
+    # Skip resampling (a full pass over every sample) if already in output format.
+    resampler = None
+    if sample_rate != out_rate or n_channels != 1:
+        resampler = av.AudioResampler(
+            format="s16", layout="mono", rate=out_rate, frame_size=frame_size
+        )
 
     stream = container.add_stream(
         "libopus", rate=out_rate, bit_rate=bitrate, layout="mono"
     )
 
-    for i in range(0, len(wav), frame_size):
-        chunk = np.ascontiguousarray(wav[i : i + frame_size].T)
-        frame = av.AudioFrame.from_ndarray(chunk, format="s16p", layout="stereo")
+    step = frame_size * n_channels
+    for i in range(0, packed.shape[1], step):
+        chunk = packed[:, i : i + step]
+        frame = av.AudioFrame.from_ndarray(chunk, format="s16", layout=layout)
         frame.rate = sample_rate
-        frames = resampler.resample(frame)
+        frames = [frame] if resampler is None else resampler.resample(frame)
 
         for frm in frames:
             container.mux(stream.encode(frm))
@@ -82,11 +104,52 @@ def setup_logging(log_path):
     logger.addHandler(ch)
 
 
+def save_file(path: Path, data: bytes):
+    """Write data to path, creating parent folders as needed."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
 def png_to_jpg(png_data: bytes, quality=75) -> bytes:
     """Convert PNG image data to JPEG format."""
     with io.BytesIO(png_data) as buf:
         img = Image.open(buf)
-        img = img.convert("RGB")
+        # convert() returns a full copy even if the mode already matches.
+        if img.mode != "RGB":
+            img = img.convert("RGB")
         jpg_buf = io.BytesIO()
         img.save(jpg_buf, format="JPEG", quality=quality, optimize=True)
         return jpg_buf.getvalue()
+
+
+def image_to_webp(image: Image.Image, quality=85, method=0) -> bytes:
+    """Encode image to WebP format."""
+    with io.BytesIO() as buf:
+        image.save(buf, format="webp", quality=quality, method=method)
+        return buf.getvalue()
+
+
+def image_to_jpg(image: Image.Image, quality=80, max_side=None) -> bytes:
+    """Encode image to JPEG format, flattening any transparency onto white.
+
+    If `max_side` is given, the image is downscaled to fit within it first.
+    """
+    # Downscale before any per-pixel conversion, keeping alpha for the flatten below.
+    if max_side is not None and max(image.size) > max_side:
+        # Pillow only resizes these modes with nearest, so convert them first.
+        if image.mode in ("1", "P"):
+            image = image.convert("RGBA" if image.mode == "P" else "L")
+        scale = max_side / max(image.size)
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        # Bilinear is good enough since it gets lossily compressed after anyways.
+        image = image.resize(size, Image.Resampling.BILINEAR)
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        bg = Image.new("RGB", image.size, "white")
+        bg.paste(image, mask=image.getchannel("A"))
+        image = bg
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    with io.BytesIO() as buf:
+        image.save(buf, format="JPEG", quality=quality)
+        return buf.getvalue()